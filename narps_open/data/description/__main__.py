@@ -27,17 +27,8 @@ arguments = parser.parse_args()
 # Initialize a TeamDescription
 information = TeamDescription(team_id = arguments.team)
 
-if arguments.dictionary == 'general':
-    print(dumps(information.general, indent = 4))
-elif arguments.dictionary == 'exclusions':
-    print(dumps(information.exclusions, indent = 4))
-elif arguments.dictionary == 'preprocessing':
-    print(dumps(information.preprocessing, indent = 4))
-elif arguments.dictionary == 'analysis':
-    print(dumps(information.analysis, indent = 4))
-elif arguments.dictionary == 'categorized_for_analysis':
-    print(dumps(information.categorized_for_analysis, indent = 4))
-elif arguments.dictionary == 'derived':
-    print(dumps(information.derived, indent = 4))
+# Print the whole description, or the sub dictionary (choices are restricted by the parser)
+if arguments.dictionary is not None:
+    print(dumps(getattr(information, arguments.dictionary), indent = 4))
 else:
     print(dumps(information, indent = 4))
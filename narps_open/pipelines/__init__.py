@@ -280,6 +280,16 @@ class Pipeline(ABC):
     def get_group_level_analysis(self):
         """ Return a Nipype workflow describing the group level analysis part of the pipeline """
 
+    def get_full_first_level_workflow(self):
+        """ Return a single Nipype workflow describing the whole first level of the pipeline
+            (preprocessing + run level + subject level), or None if the pipeline does not
+            provide such a workflow.
+            Connecting the three parts inside one workflow allows the nipype scheduler to
+            see the whole graph, hence starting a subject's run level analysis as soon as
+            its preprocessing is done.
+        """
+        return None
+
     def get_preprocessing_outputs(self):
         """ Return the names of the files the preprocessing is supposed to generate. """
         return []
@@ -3,12 +3,16 @@
 
 """ This module allows to run pipelines from NARPS open. """
 
-from os.path import isfile
+from os import scandir
+from os.path import basename, dirname
 from importlib import import_module
-from random import choices
+from random import sample
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
 
 from nipype import Workflow
+from nipype.pipeline.plugins import MultiProcPlugin
 
 from narps_open.pipelines import Pipeline, implemented_pipelines
 from narps_open.data.participants import (
@@ -18,11 +22,104 @@ from narps_open.data.participants import (
     )
 from narps_open.utils.configuration import Configuration
 
+def _list_files(directory: str) -> set:
+    """ Return the set of names of the files inside a directory (empty if it does not exist) """
+    try:
+        with scandir(directory or '.') as entries:
+            return {e.name for e in entries if e.is_file()}
+    except OSError:
+        return set()
+
+def get_missing_files(files, directory_contents: dict = None) -> list:
+    """ Return the files of a list that do not exist, in the same order.
+        Each parent directory is listed once, instead of checking each file separately.
+        Listings are I/O bound, hence they are performed concurrently in a thread pool.
+
+    Arguments:
+        - files: iterable of str, the files to check
+        - directory_contents: dict (None by default), listings of directories already
+            performed, updated with the new listings. Pass the same dict to several calls
+            to reuse the listings, as long as files were not created in the meantime.
+    """
+    if directory_contents is None:
+        directory_contents = {}
+
+    # Files are iterated over twice, hence generators must be consumed once
+    files = files if isinstance(files, (list, tuple)) else list(files)
+    directories = [d for d in dict.fromkeys(dirname(f) for f in files)
+        if d not in directory_contents]
+
+    if len(directories) > 1:
+        with ThreadPoolExecutor(max_workers = min(32, len(directories))) as executor:
+            directory_contents.update(zip(directories, executor.map(_list_files, directories)))
+    else:
+        directory_contents.update({d: _list_files(d) for d in directories})
+
+    return [f for f in files if basename(f) not in directory_contents[dirname(f)]]
+
+class PersistentMultiProcPlugin(MultiProcPlugin):
+    """ A nipype MultiProc plugin whose pool of processes is not shut down at the end
+        of a run, so that it can be reused to run several workflows.
+        Call shutdown() once all workflows are done.
+    """
+
+    def _postrun_check(self):
+        """ Keep the pool of processes alive after the run, only dropping the task results """
+        self._taskresult.clear()
+
+    def shutdown(self) -> None:
+        """ Shut the pool of processes down """
+        self.pool.shutdown()
+
+class EventDrivenMultiProcPlugin(PersistentMultiProcPlugin):
+    """ A PersistentMultiProcPlugin whose scheduler wakes up as soon as a task is done,
+        instead of sleeping for the whole poll duration between two scheduling loops.
+        The poll duration is only used as a timeout.
+
+        NB: this relies on internals of nipype's plugins (checked against nipype 1.11):
+            - MultiProcPlugin._async_callback, called when a task is done ;
+            - DistributedPluginBase._send_procs_to_workers, called once per scheduling loop,
+                right before the loop sleeps until the end of the poll duration ;
+            - DistributedPluginBase.pending_tasks and proc_done, the scheduler's state.
+        test_event_driven_plugin in tests/test_runner.py fails if the scheduler falls
+        back to polling.
+    """
+
+    def __init__(self, plugin_args = None):
+        super().__init__(plugin_args = plugin_args)
+        self._task_done = Event()
+        self._wait_timeout = None
+
+    def run(self, graph, config, updatehash = False):
+        """ Run the graph, replacing nipype's sleep by a wait for a task to be done """
+        self._wait_timeout = float(config['execution']['poll_sleep_duration'])
+        config = {**config, 'execution': {**config['execution'], 'poll_sleep_duration': 0}}
+        super().run(graph, config, updatehash = updatehash)
+
+    def _async_callback(self, args):
+        """ Wake the scheduler up when a task is done """
+        try:
+            super()._async_callback(args)
+        finally:
+            self._task_done.set()
+
+    def _send_procs_to_workers(self, updatehash = False, graph = None):
+        """ Submit ready jobs, then wait for a task to be done before the next loop """
+        super()._send_procs_to_workers(updatehash = updatehash, graph = graph)
+
+        # Nothing to wait for once all jobs are done
+        if self.pending_tasks or not self.proc_done.all():
+            self._task_done.wait(timeout = self._wait_timeout)
+            self._task_done.clear()
+
 class PipelineRunner():
     """ A class that allows to run a NARPS pipeline. """
 
+    __slots__ = ('_pipeline', '_pipeline_class_name', '_team_id')
+
     def __init__(self, team_id: str = '') -> None:
         self._pipeline = None
+        self._pipeline_class_name = None
 
         # Set team_id. It's important to use the property setter here,
         # so that the code inside it is executed. That would not be the
@@ -31,37 +128,50 @@ class PipelineRunner():
 
     @property
     def pipeline(self) -> Pipeline:
-        """ Getter for property pipeline """
+        """ Getter for property pipeline.
+            The pipeline is only instantiated at first access, to avoid importing its module
+            when it is not needed.
+        """
+        if self._pipeline is None:
+            class_type = getattr(
+                import_module('narps_open.pipelines.team_'+self._team_id),
+                self._pipeline_class_name)
+            self._pipeline = class_type()
+
         return self._pipeline
 
     @property
     def subjects(self) -> list:
         """ Getter for property subjects """
-        return self._pipeline.subject_list
+        return self.pipeline.subject_list
 
     @subjects.setter
     def subjects(self, value: list) -> None:
         """ Setter for property subjects """
 
-        all_participants = get_all_participants()
-        for subject_id in value:
-            if str(int(subject_id)).zfill(3) not in all_participants:
+        all_participants = set(get_all_participants())
+        subject_list = [f'{int(subject_id):03d}' for subject_id in value]
+        for subject_id, formatted_id in zip(value, subject_list):
+            if formatted_id not in all_participants:
                 raise AttributeError(f'Subject ID {subject_id} is not valid')
 
-        self._pipeline.subject_list = list(dict.fromkeys(
-            [str(int(subject_id)).zfill(3) for subject_id in value])) # remove duplicates
+        self.pipeline.subject_list = list(dict.fromkeys(subject_list)) # remove duplicates
 
     @subjects.setter
     def random_nb_subjects(self, value: int) -> None:
         """ Setter for property random_nb_subjects """
-        # Generate a random list of subjects
-        self._pipeline.subject_list = choices(get_participants(self.team_id), k = value)
+        if value < 0:
+            raise AttributeError(f'Number of subjects {value} must not be negative')
+
+        # Generate a random list of distinct subjects
+        participants = get_participants(self.team_id)
+        self.pipeline.subject_list = sample(participants, k = min(value, len(participants)))
 
     @subjects.setter
     def nb_subjects(self, value: int) -> None:
         """ Setter for property nb_subjects """
         # Get a subset of participants
-        self._pipeline.subject_list = get_participants_subset(value)
+        self.pipeline.subject_list = get_participants_subset(value)
 
     @property
     def team_id(self) -> str:
@@ -70,21 +180,19 @@ class PipelineRunner():
 
     @team_id.setter
     def team_id(self, value: str) -> None:
-        """ Setter for property random_nb_subjects """
-        self._team_id = value
+        """ Setter for property team_id """
 
         # It's up to the PipelineRunner to find the right pipeline, based on the team ID
-        if self._team_id not in implemented_pipelines:
-            raise KeyError(f'Wrong team ID : {self.team_id}')
-
-        if implemented_pipelines[self._team_id] is None:
-            raise NotImplementedError(f'Pipeline not implemented for team : {self.team_id}')
+        class_name = implemented_pipelines.get(value)
+        if class_name is None:
+            if value not in implemented_pipelines:
+                raise KeyError(f'Wrong team ID : {value}')
+            raise NotImplementedError(f'Pipeline not implemented for team : {value}')
 
-        # Instantiate the pipeline
-        class_type = getattr(
-            import_module('narps_open.pipelines.team_'+self._team_id),
-            implemented_pipelines[self._team_id])
-        self._pipeline = class_type()
+        # The pipeline will be instantiated at first access
+        self._team_id = value
+        self._pipeline_class_name = class_name
+        self._pipeline = None
 
     def start(self, first_level_only: bool = False, group_level_only: bool = False) -> None:
         """
@@ -101,56 +209,143 @@ class PipelineRunner():
         if first_level_only and group_level_only:
             raise AttributeError('first_level_only and group_level_only cannot both be True')
 
+        runner_configuration = Configuration()['runner']
+        nb_procs = runner_configuration['nb_procs']
+        parallel_sub_workflows = runner_configuration.get('parallel_sub_workflows', False)
+        event_driven_scheduler = runner_configuration.get('event_driven_scheduler', False)
+        poll_sleep_duration = runner_configuration.get('poll_sleep_duration')
+
+        workflow_levels = self._get_workflow_levels(first_level_only, group_level_only)
+
+        # The same pool of processes is reused by all the workflows run sequentially
+        plugin = self._get_plugin(nb_procs, event_driven_scheduler)
+
+        # Launch workflows
+        try:
+            for level in workflow_levels:
+                if parallel_sub_workflows and len(level) > 1 \
+                    and len({w.base_dir for w in level}) == 1:
+                    # Sub workflows of a same level do not depend on each other: gather them
+                    # inside one workflow, so that nipype schedules them in the same run.
+                    # Their working directories move under the parent workflow's directory,
+                    # hence this is only done if they share the same base_dir.
+                    parent = Workflow(
+                        base_dir = level[0].base_dir,
+                        name = 'parallel_' + '_'.join(w.name for w in level)
+                        )
+                    parent.add_nodes(level)
+                    self._run_workflow(parent, plugin, poll_sleep_duration)
+                else:
+                    for workflow in level:
+                        self._run_workflow(workflow, plugin, poll_sleep_duration)
+        finally:
+            if plugin is not None:
+                plugin.shutdown()
+
+    def _get_workflow_levels(self, first_level_only: bool, group_level_only: bool) -> list:
+        """ Return the workflows to run, as a list of levels, each level being a list of
+            workflows. Levels the pipeline does not implement (None) are skipped.
+        """
         # Generate workflow list
         workflow_list = []
         if not group_level_only:
-            workflow_list += [
-                self._pipeline.get_preprocessing(),
-                self._pipeline.get_run_level_analysis(),
-                self._pipeline.get_subject_level_analysis(),
-            ]
+            full_first_level = self.pipeline.get_full_first_level_workflow()
+            if full_first_level is not None:
+                workflow_list += [full_first_level]
+            else:
+                workflow_list += [
+                    self.pipeline.get_preprocessing(),
+                    self.pipeline.get_run_level_analysis(),
+                    self.pipeline.get_subject_level_analysis(),
+                ]
         if not first_level_only:
             workflow_list += [
-                self._pipeline.get_group_level_analysis()
+                self.pipeline.get_group_level_analysis()
             ]
 
-        nb_procs = Configuration()['runner']['nb_procs']
-
-        # Launch workflows
+        # Normalize levels into lists of workflows, and check their types before running any
+        workflow_levels = []
         for workflow in workflow_list:
             if workflow is None:
-                pass
-            elif isinstance(workflow, list):
-                for sub_workflow in workflow:
-                    if not isinstance(sub_workflow, Workflow):
-                        raise AttributeError('Workflow must be of type nipype.Workflow')
-
-                    if nb_procs > 1:
-                        sub_workflow.run('MultiProc', plugin_args={'n_procs': nb_procs})
-                    else:
-                        sub_workflow.run()
-            else:
-                if not isinstance(workflow, Workflow):
-                    raise AttributeError('Workflow must be of type nipype.Workflow')
+                continue
+            level = workflow if isinstance(workflow, list) else [workflow]
+            if not all(isinstance(w, Workflow) for w in level):
+                raise AttributeError('Workflow must be of type nipype.Workflow')
+            workflow_levels.append(level)
 
-                if nb_procs > 1:
-                    workflow.run('MultiProc', plugin_args={'n_procs': nb_procs})
-                else:
-                    workflow.run()
+        return workflow_levels
 
-    def get_missing_first_level_outputs(self):
-        """ Return the list of missing files after computations of the first level """
-        files = self._pipeline.get_preprocessing_outputs()
-        files += self._pipeline.get_run_level_outputs()
-        files += self._pipeline.get_subject_level_outputs()
+    @staticmethod
+    def _get_plugin(
+        nb_procs: int, event_driven_scheduler: bool = False) -> PersistentMultiProcPlugin:
+        """ Return a MultiProc plugin instance using nb_procs processes,
+            or None if only one process is allowed (i.e.: use nipype's Linear plugin)
 
-        return [f for f in files if not isfile(f)]
+        Arguments:
+            - nb_procs: int, the number of processes allowed
+            - event_driven_scheduler: bool (False by default), True to get an
+                EventDrivenMultiProcPlugin
+        """
+        if nb_procs <= 1:
+            return None
+
+        if event_driven_scheduler:
+            return EventDrivenMultiProcPlugin(plugin_args = {'n_procs': nb_procs})
+
+        return PersistentMultiProcPlugin(plugin_args = {'n_procs': nb_procs})
+
+    @staticmethod
+    def _run_workflow(
+        workflow: Workflow,
+        plugin: PersistentMultiProcPlugin = None,
+        poll_sleep_duration: float = None
+        ) -> None:
+        """ Run a nipype Workflow
+
+        Arguments:
+            - workflow: Workflow, the workflow to run
+            - plugin: PersistentMultiProcPlugin (None by default, i.e.: Linear plugin),
+                the plugin instance used to run the workflow
+            - poll_sleep_duration: float (None by default, i.e.: keep nipype's setting),
+                time (in s) the scheduler waits between two checks of the running jobs
+        """
+        if poll_sleep_duration is not None:
+            workflow.config['execution']['poll_sleep_duration'] = poll_sleep_duration
+
+        workflow.run(plugin)
+
+    def get_missing_first_level_outputs(self, directory_contents: dict = None):
+        """ Return the list of missing files after computations of the first level
+
+        Arguments:
+            - directory_contents: dict (None by default), directory listings to reuse,
+                see get_missing_files
+        """
+        if directory_contents is None:
+            directory_contents = {}
 
-    def get_missing_group_level_outputs(self):
-        """ Return the list of missing files after computations of the group level """
-        files = self._pipeline.get_group_level_outputs()
+        # Check the output lists one after the other, sharing directory listings,
+        # so that only one of these lists is kept in memory at a time
+        missing_files = []
+        for get_outputs in [
+            self.pipeline.get_preprocessing_outputs,
+            self.pipeline.get_run_level_outputs,
+            self.pipeline.get_subject_level_outputs
+            ]:
+            missing_files += get_missing_files(get_outputs(), directory_contents)
+
+        return missing_files
+
+    def get_missing_group_level_outputs(self, directory_contents: dict = None):
+        """ Return the list of missing files after computations of the group level
+
+        Arguments:
+            - directory_contents: dict (None by default), directory listings to reuse,
+                see get_missing_files
+        """
+        files = self.pipeline.get_group_level_outputs()
 
-        return [f for f in files if not isfile(f)]
+        return get_missing_files(files, directory_contents)
 
 if __name__ == '__main__':
 
@@ -159,11 +354,11 @@ if __name__ == '__main__':
     parser.add_argument('-t', '--team', type=str, required=True,
         help='the team ID')
     subjects = parser.add_mutually_exclusive_group(required=True)
-    subjects.add_argument('-r', '--rsubjects', type=str,
+    subjects.add_argument('-r', '--rsubjects', type=int,
         help='the number of subjects to be randomly selected')
-    subjects.add_argument('-s', '--subjects', nargs='+', type=str, action='extend',
+    subjects.add_argument('-s', '--subjects', nargs='+', type=str,
         help='a list of subjects')
-    subjects.add_argument('-n', '--nsubjects', type=str,
+    subjects.add_argument('-n', '--nsubjects', type=int,
         help='the number of subjects to be randomly selected')
     levels = parser.add_mutually_exclusive_group(required=False)
     levels.add_argument('-g', '--group', action='store_true', default=False,
@@ -176,28 +371,38 @@ if __name__ == '__main__':
 
     # Initialize a PipelineRunner
     runner = PipelineRunner(team_id = arguments.team)
-    runner.pipeline.directories.dataset_dir = Configuration()['directories']['dataset']
-    runner.pipeline.directories.results_dir = Configuration()['directories']['reproduced_results']
-    runner.pipeline.directories.set_output_dir_with_team_id(arguments.team)
-    runner.pipeline.directories.set_working_dir_with_team_id(arguments.team)
 
-    # Handle subject
+    # Handle subject, before accessing the pipeline, so that invalid subject IDs
+    # are reported before the pipeline gets instantiated
     if arguments.subjects is not None:
-        runner.subjects = arguments.subjects
+        try:
+            runner.subjects = arguments.subjects
+        except (AttributeError, ValueError) as error:
+            parser.error(str(error))
     elif arguments.rsubjects is not None:
-        runner.random_nb_subjects = int(arguments.rsubjects)
+        if arguments.rsubjects < 1:
+            parser.error(f'Number of subjects {arguments.rsubjects} must be positive')
+        runner.random_nb_subjects = arguments.rsubjects
     else:
-        runner.nb_subjects = int(arguments.nsubjects)
+        if arguments.nsubjects < 1:
+            parser.error(f'Number of subjects {arguments.nsubjects} must be positive')
+        runner.nb_subjects = arguments.nsubjects
+
+    directories_config = Configuration()['directories']
+    runner.pipeline.directories.dataset_dir = directories_config['dataset']
+    runner.pipeline.directories.results_dir = directories_config['reproduced_results']
+    runner.pipeline.directories.set_output_dir_with_team_id(arguments.team)
+    runner.pipeline.directories.set_working_dir_with_team_id(arguments.team)
 
     # Check data
     if arguments.check:
-        missing_files = []
+        listings = {} # directory listings shared by both levels
         print('Missing files for team', arguments.team, 'after running',
             len(runner.pipeline.subject_list), 'subjects:')
         if not arguments.group:
-            print('First level:', runner.get_missing_first_level_outputs())
+            print('First level:', runner.get_missing_first_level_outputs(listings))
         if not arguments.first:
-            print('Group level:', runner.get_missing_group_level_outputs())
+            print('Group level:', runner.get_missing_group_level_outputs(listings))
 
     # Start the runner
     else:
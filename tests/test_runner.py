@@ -14,6 +14,8 @@ Usage:
 from os import remove
 from os.path import join, isfile, abspath
 from pathlib import Path
+from shutil import rmtree
+from time import time
 
 from datetime import datetime
 
@@ -23,10 +25,19 @@ from nipype import Node, Workflow
 from nipype.interfaces.utility import Function
 
 from narps_open.utils.configuration import Configuration
-from narps_open.runner import PipelineRunner
+from narps_open.runner import (
+    PipelineRunner,
+    PersistentMultiProcPlugin,
+    EventDrivenMultiProcPlugin,
+    get_missing_files
+    )
 from narps_open.pipelines import Pipeline
 from narps_open.pipelines.team_2T6S import PipelineTeam2T6S
 
+def increment(value: int) -> int:
+    """ Function used inside a nipype Node, to return its input incremented by 1 """
+    return value + 1
+
 class MockupPipeline(Pipeline):
     """ A simple Pipeline class for test purposes """
 
@@ -177,9 +188,79 @@ class MockupWrongPipeline2(Pipeline):
     def get_hypotheses_outputs(self):
         return None
 
+class MockupSubWorkflowsPipeline(MockupPipeline):
+    """ A simple Pipeline class for test purposes, with a group level made of sub workflows """
+
+    def get_group_level_analysis(self):
+        """ Return a list of fake group level workflows """
+        return [
+            self.create_workflow('TestPipelineRunner_group_level_workflow_a'),
+            self.create_workflow('TestPipelineRunner_group_level_workflow_b')
+            ]
+
+class MockupFullFirstLevelPipeline(MockupPipeline):
+    """ A simple Pipeline class for test purposes, providing a full first level workflow """
+
+    def get_full_first_level_workflow(self):
+        """ Return a fake first level workflow, made of the three first level workflows """
+        preprocessing = self.get_preprocessing()
+        run_level = self.get_run_level_analysis()
+        subject_level = self.get_subject_level_analysis()
+
+        workflow = Workflow(
+            base_dir = Configuration()['directories']['test_runs'],
+            name = 'TestPipelineRunner_full_first_level_workflow'
+            )
+        workflow.connect(preprocessing, 'node_1._', run_level, 'node_1._')
+        workflow.connect(run_level, 'node_1._', subject_level, 'node_1._')
+
+        return workflow
+
+class MockupSubWorkflowsBaseDirPipeline(MockupSubWorkflowsPipeline):
+    """ A simple Pipeline class for test purposes, with a group level made of sub workflows
+        that do not share the same base_dir
+    """
+
+    def get_group_level_analysis(self):
+        """ Return a list of fake group level workflows, with different base_dir """
+        workflows = super().get_group_level_analysis()
+        workflows[1].base_dir = join(workflows[1].base_dir, 'other_base_dir')
+        return workflows
+
 class TestPipelineRunner:
     """ A class that contains all the unit tests for the PipelineRunner class."""
 
+    @staticmethod
+    @mark.unit_test
+    def test_get_missing_files():
+        """ Test the get_missing_files function """
+        test_dir = abspath(join(Configuration()['directories']['test_runs'], 'test_missing_files'))
+        Path(test_dir).mkdir(parents = True, exist_ok = True)
+        existing_file = join(test_dir, 'existing_file.md')
+        Path(existing_file).touch()
+
+        files = [
+            join(test_dir, 'missing_file_1.md'),
+            existing_file,
+            join(test_dir, 'missing_dir', 'missing_file_2.md'),
+            join(test_dir, 'missing_file_3.md')
+            ]
+        assert get_missing_files(files) == [files[0], files[2], files[3]]
+        assert get_missing_files([existing_file]) == []
+        assert get_missing_files([]) == []
+        assert get_missing_files(f for f in files) == [files[0], files[2], files[3]]
+
+        # Directory listings are reused when passed to several calls
+        directory_contents = {}
+        assert get_missing_files(files, directory_contents) == [files[0], files[2], files[3]]
+        assert directory_contents[test_dir] == {'existing_file.md'}
+        Path(files[0]).touch()
+        assert get_missing_files(files, directory_contents) == [files[0], files[2], files[3]]
+        assert get_missing_files(files) == [files[2], files[3]]
+
+        remove(files[0])
+        remove(existing_file)
+
     @staticmethod
     @mark.unit_test
     def test_create():
@@ -199,6 +280,7 @@ class TestPipelineRunner:
 
         # 4 - Instantiate a runner with an implemented team id
         runner = PipelineRunner('2T6S')
+        assert runner._pipeline is None # pipeline is instantiated at first access
         assert isinstance(runner.pipeline, PipelineTeam2T6S)
         assert runner.team_id == '2T6S'
 
@@ -206,6 +288,20 @@ class TestPipelineRunner:
         with raises(NotImplementedError):
             runner.team_id = '08MQ'
 
+        # 5b - The runner keeps its previous pipeline after a rejected team id
+        assert runner.team_id == '2T6S'
+        assert isinstance(runner.pipeline, PipelineTeam2T6S)
+
+        runner = PipelineRunner('2T6S')
+        with raises(KeyError):
+            runner.team_id = 'wrong_id'
+        assert runner.team_id == '2T6S'
+        assert isinstance(runner.pipeline, PipelineTeam2T6S)
+
+        # 6 - Setting an unknown attribute is not allowed
+        with raises(AttributeError):
+            setattr(runner, 'unknown_attribute', True)
+
     @staticmethod
     @mark.unit_test
     def test_subjects():
@@ -219,6 +315,17 @@ class TestPipelineRunner:
         runner.random_nb_subjects = 4
         assert len(runner.subjects) == 4
 
+        # Check subjects are not selected twice
+        runner.random_nb_subjects = 108
+        assert len(set(runner.subjects)) == 108
+        runner.random_nb_subjects = 200
+        assert len(set(runner.subjects)) == 108
+        runner.random_nb_subjects = 0
+        assert runner.subjects == []
+        with raises(AttributeError):
+            runner.random_nb_subjects = -1
+        runner.random_nb_subjects = 4
+
         # Check formatting and consistency
         for subject in runner.subjects:
             assert isinstance(subject, str)
@@ -394,3 +501,165 @@ class TestPipelineRunner:
         # 4 - Check again for missing files
         missing_files = runner.get_missing_group_level_outputs()
         assert len(missing_files) == 0
+
+    @staticmethod
+    @mark.unit_test
+    def test_start_parallel_sub_workflows():
+        """ Test running the sub workflows of a same level concurrently """
+        # Use more, as many, and less processes than sub workflows
+        for nb_procs in [8, 2, 1]:
+            configuration = Configuration()['runner']
+            previous_nb_procs = configuration['nb_procs']
+            configuration['parallel_sub_workflows'] = True
+            configuration['nb_procs'] = nb_procs
+            try:
+                runner = PipelineRunner('2T6S')
+                runner._pipeline = MockupSubWorkflowsPipeline() # hack the runner
+                runner.start(False, True)
+            finally:
+                configuration['parallel_sub_workflows'] = False
+                configuration['nb_procs'] = previous_nb_procs
+
+            # Read results of the pipeline, sub workflows may have run in any order
+            with open(
+                join(Configuration()['directories']['test_runs'], 'test_runner.txt'),
+                'r', encoding = 'utf-8') as file:
+                lines = file.readlines()
+
+            assert len(lines) == 4
+            for workflow in [
+                'TestPipelineRunner_group_level_workflow_a',
+                'TestPipelineRunner_group_level_workflow_b']:
+                assert 'MockupPipeline : '+workflow+' node_1\n' in lines
+                assert 'MockupPipeline : '+workflow+' node_2\n' in lines
+
+    @staticmethod
+    @mark.unit_test
+    def test_start_parallel_sub_workflows_base_dir():
+        """ Test sub workflows with different base_dir are run one after the other """
+        Configuration()['runner']['parallel_sub_workflows'] = True
+        try:
+            runner = PipelineRunner('2T6S')
+            runner._pipeline = MockupSubWorkflowsBaseDirPipeline() # hack the runner
+            runner.start(False, True)
+        finally:
+            Configuration()['runner']['parallel_sub_workflows'] = False
+
+        # Read results of the pipeline, sub workflows must have run in order
+        with open(
+            join(Configuration()['directories']['test_runs'], 'test_runner.txt'),
+            'r', encoding = 'utf-8') as file:
+            for workflow in [
+                'TestPipelineRunner_group_level_workflow_a',
+                'TestPipelineRunner_group_level_workflow_b']:
+                assert file.readline() == 'MockupPipeline : '+workflow+' node_1\n'
+                assert file.readline() == 'MockupPipeline : '+workflow+' node_2\n'
+
+    @staticmethod
+    @mark.unit_test
+    def test_start_full_first_level():
+        """ Test running a pipeline providing a full first level workflow """
+        runner = PipelineRunner('2T6S')
+        runner._pipeline = MockupFullFirstLevelPipeline() # hack the runner
+        runner.start(True, False)
+
+        # Read results of the pipeline, nodes may have run in any order
+        with open(
+            join(Configuration()['directories']['test_runs'], 'test_runner.txt'),
+            'r', encoding = 'utf-8') as file:
+            lines = file.readlines()
+
+        assert len(lines) == 6
+        for workflow in [
+            'TestPipelineRunner_preprocessing_workflow',
+            'TestPipelineRunner_run_level_workflow',
+            'TestPipelineRunner_subject_level_workflow']:
+            assert 'MockupPipeline : '+workflow+' node_1\n' in lines
+            assert 'MockupPipeline : '+workflow+' node_2\n' in lines
+
+    @staticmethod
+    @mark.unit_test
+    def test_start_event_driven_scheduler():
+        """ Test running a pipeline with the event driven scheduler """
+        Configuration()['runner']['event_driven_scheduler'] = True
+        try:
+            runner = PipelineRunner('2T6S')
+            runner._pipeline = MockupPipeline() # hack the runner by setting a test Pipeline
+            runner.start()
+        finally:
+            Configuration()['runner']['event_driven_scheduler'] = False
+
+        # Read results of the pipeline
+        with open(
+            join(Configuration()['directories']['test_runs'], 'test_runner.txt'),
+            'r', encoding = 'utf-8') as file:
+            for workflow in [
+                'TestPipelineRunner_preprocessing_workflow',
+                'TestPipelineRunner_run_level_workflow',
+                'TestPipelineRunner_subject_level_workflow',
+                'TestPipelineRunner_group_level_workflow']:
+                assert file.readline() == 'MockupPipeline : '+workflow+' node_1\n'
+                assert file.readline() == 'MockupPipeline : '+workflow+' node_2\n'
+
+class TestMultiProcPlugins:
+    """ A class that contains all the unit tests for the MultiProc plugins of the runner module."""
+
+    @staticmethod
+    @mark.unit_test
+    def test_persistent_plugin():
+        """ Test running several workflows on the same PersistentMultiProcPlugin """
+        pipeline = MockupPipeline()
+        workflows = [
+            'TestPipelineRunner_persistent_plugin_workflow_a',
+            'TestPipelineRunner_persistent_plugin_workflow_b']
+
+        plugin = PersistentMultiProcPlugin(plugin_args = {'n_procs': 2})
+        try:
+            for workflow in workflows:
+                pipeline.create_workflow(workflow).run(plugin)
+
+                # Task results are not kept from one run to the other
+                assert plugin._taskresult == {}
+        finally:
+            plugin.shutdown()
+
+        # Read results of the workflows
+        with open(pipeline.test_file, 'r', encoding = 'utf-8') as file:
+            for workflow in workflows:
+                assert file.readline() == 'MockupPipeline : '+workflow+' node_1\n'
+                assert file.readline() == 'MockupPipeline : '+workflow+' node_2\n'
+
+    @staticmethod
+    @mark.unit_test
+    def test_event_driven_plugin():
+        """ Test the EventDrivenMultiProcPlugin wakes up before the end of the poll duration """
+        nb_nodes = 4
+        poll_sleep_duration = 5
+
+        # Create a chain of quick nodes, each one waiting for the previous one
+        workflow = Workflow(
+            base_dir = Configuration()['directories']['test_runs'],
+            name = 'TestPipelineRunner_event_driven_plugin_workflow'
+            )
+        rmtree(join(workflow.base_dir, workflow.name), ignore_errors = True) # no cache
+        nodes = [Node(Function(
+            input_names = ['value'],
+            output_names = ['value'],
+            function = increment),
+            name = f'node_{node_id}'
+            ) for node_id in range(nb_nodes)]
+        nodes[0].inputs.value = 0
+        for previous_node, node in zip(nodes[:-1], nodes[1:]):
+            workflow.connect(previous_node, 'value', node, 'value')
+        workflow.config['execution']['poll_sleep_duration'] = poll_sleep_duration
+
+        plugin = EventDrivenMultiProcPlugin(plugin_args = {'n_procs': 2})
+        try:
+            start_time = time()
+            workflow.run(plugin)
+            duration = time() - start_time
+        finally:
+            plugin.shutdown()
+
+        # Polling would take about nb_nodes * poll_sleep_duration seconds
+        assert duration < nb_nodes * poll_sleep_duration / 2